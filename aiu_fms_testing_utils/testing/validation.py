@@ -1,6 +1,9 @@
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from pathlib import Path
 from typing import List, Tuple, Callable, MutableMapping, Any, Optional
 
+import numpy as np
 import torch
 from aiu_fms_testing_utils.utils.aiu_setup import dprint
 import os
@@ -12,9 +15,39 @@ class LogitsExtractorHook(
         Tuple[torch.Tensor, MutableMapping[str, Any]],
     ]
 ):
-    def __init__(self):
+    def __init__(
+        self, mmap_path: Optional[str] = None, max_new_tokens: Optional[int] = None
+    ):
+        """
+        :param mmap_path: optional file to stream the logits of every step to (as float32), rather than keeping them
+            in memory until the end of the generation
+        :param max_new_tokens: the maximum number of generation steps, required when mmap_path is set
+        """
         super().__init__()
-        self.extracted_logits: Optional[torch.Tensor] = None
+        if mmap_path is not None and max_new_tokens is None:
+            raise ValueError("must provide max_new_tokens when mmap_path is set")
+        self.mmap_path = mmap_path
+        self.max_new_tokens = max_new_tokens
+        self._logits_buf: List[torch.Tensor] = []
+        self._logits_mmap: Optional[np.memmap] = None
+        self._num_steps = 0
+        self._extracted_logits: Optional[torch.Tensor] = None
+
+    @property
+    def extracted_logits(self) -> Optional[torch.Tensor]:
+        """the logits of every generation step stacked as (batch, steps, vocab), or None if nothing was extracted"""
+        if self._extracted_logits is None and self._num_steps > 0:
+            if self._logits_mmap is not None:
+                # a view of the memory mapped file, nothing is read until it gets used
+                self._extracted_logits = torch.from_numpy(
+                    self._logits_mmap[: self._num_steps]
+                ).transpose(0, 1)
+            else:
+                # materialize once instead of growing a tensor with torch.cat every step
+                self._extracted_logits = torch.stack(self._logits_buf, dim=1)
+                # hold views of the stacked tensor from now on so the per-step copies are freed
+                self._logits_buf = list(self._extracted_logits.unbind(1))
+        return self._extracted_logits
 
     def __call__(
         self,
@@ -23,12 +56,24 @@ class LogitsExtractorHook(
         next_val: torch.Tensor,
         kwargs,
     ):
-        if self.extracted_logits is None:
-            self.extracted_logits = logits.unsqueeze(1)
+        if self.mmap_path is None:
+            # logits is usually a view of the full model output (e.g. the whole prefill), keep a compact copy so
+            # that output can be released
+            self._logits_buf.append(logits.clone())
         else:
-            self.extracted_logits = torch.cat(
-                (self.extracted_logits, logits.unsqueeze(1)), dim=1
+            if self._logits_mmap is None:
+                # laid out (steps, batch, vocab) so every step is a single contiguous write
+                self._logits_mmap = np.memmap(
+                    self.mmap_path,
+                    dtype=np.float32,
+                    mode="w+",
+                    shape=(self.max_new_tokens, logits.size(0), logits.size(-1)),
+                )
+            self._logits_mmap[self._num_steps] = (
+                logits.detach().to(device="cpu", dtype=torch.float32).numpy()
             )
+        self._num_steps += 1
+        self._extracted_logits = None
         return next_val, kwargs
 
 
@@ -40,14 +85,27 @@ class StaticTokenInjectorHook(
 ):
     def __init__(self, static_tokens: List[torch.Tensor], device_type: str = "cpu"):
         super().__init__()
-        self.static_tokens = torch.tensor(
-            static_tokens, device=device_type
-        ).t()  # transposing so batch tokens per token_position
+        if isinstance(static_tokens, torch.Tensor):
+            stacked_tokens = static_tokens
+        elif isinstance(static_tokens[0], torch.Tensor):
+            stacked_tokens = torch.stack(static_tokens)
+        else:
+            stacked_tokens = torch.as_tensor(static_tokens)
+
+        # laid out once as (num_tokens, batch_size, 1) so each step copies a contiguous (batch_size, 1) slice
+        self.static_tokens = (
+            stacked_tokens.to(device_type)
+            .reshape(len(stacked_tokens), -1)
+            .t()
+            .unsqueeze(-1)
+            .contiguous()
+        )
 
     def __call__(
         self, token_position: int, logits: torch.Tensor, next_val: torch.Tensor, kwargs
     ):
-        next_val.copy_(self.static_tokens[token_position].unsqueeze(1))
+        # token_position must be an int, it selects the (batch_size, 1) tokens to inject
+        next_val.copy_(self.static_tokens[token_position])
         return next_val, kwargs
 
 
@@ -57,13 +115,28 @@ class GoldenTokenHook(
         Tuple[torch.Tensor, MutableMapping[str, Any]],
     ]
 ):
-    def __init__(self, static_tokens: torch.Tensor, device_type: str = "cpu"):
+    def __init__(
+        self,
+        static_tokens: torch.Tensor,
+        device_type: str = "cpu",
+        mmap_path: Optional[str] = None,
+        max_new_tokens: Optional[int] = None,
+    ):
+        """
+        :param static_tokens: the tokens to inject at every generation step
+        :param device_type: the device to keep the static tokens on
+        :param mmap_path: optional file to stream the extracted logits to, see LogitsExtractorHook
+        :param max_new_tokens: the maximum number of generation steps, defaults to the number of static tokens
+        """
         super().__init__()
-        self.logits_extractor = LogitsExtractorHook()
-        self.extracted_logits = None
         self.token_injector = StaticTokenInjectorHook(
             static_tokens, device_type=device_type
         )
+        if mmap_path is not None and max_new_tokens is None:
+            max_new_tokens = len(self.token_injector.static_tokens)
+        self.logits_extractor = LogitsExtractorHook(
+            mmap_path=mmap_path, max_new_tokens=max_new_tokens
+        )
 
     def __call__(
         self, token_position: int, logits: torch.Tensor, next_val: torch.Tensor, kwargs
@@ -71,27 +144,79 @@ class GoldenTokenHook(
         next_val, kwargs = self.logits_extractor(
             token_position, logits, next_val, kwargs
         )
-        self.extracted_logits = self.logits_extractor.extracted_logits
         return self.token_injector(token_position, logits, next_val, kwargs)
 
+    @property
+    def extracted_logits(self) -> Optional[torch.Tensor]:
+        """the logits extracted so far, stacked lazily by the underlying LogitsExtractorHook on first access"""
+        return self.logits_extractor.extracted_logits
+
+
+def _maybe_stack(tensors):
+    # stack a list of same-shaped tensors into a single batched tensor, anything else is returned as is
+    if (
+        isinstance(tensors, list)
+        and len(tensors) > 0
+        and all(
+            isinstance(t, torch.Tensor) and t.shape == tensors[0].shape for t in tensors
+        )
+    ):
+        return torch.stack(tensors)
+    return tensors
+
 
 class ValidationInfo:
-    def __init__(self, validation_info_list):
+    """The tokens and (optionally) logits of a batch of sentences
+
+    The information is stored batched (structure of arrays), tokens as a (batch_size, num_tokens) tensor and logits
+    as a (batch_size, num_new_tokens, vocab_size) tensor. Sentences of different lengths (e.g. prompts loaded from text)
+    are kept as a list with one tensor per sentence.
+
+    :param validation_info_list: optional list with a dict[tokens -> torch.tensor, logits -> torch.tensor] per sentence
+    :param tokens: the batched tokens, used when validation_info_list is not given
+    :param logits: the batched logits, used when validation_info_list is not given
+    """
+
+    def __init__(
+        self,
+        validation_info_list: Optional[List[MutableMapping[str, Any]]] = None,
+        tokens: Optional[torch.Tensor] = None,
+        logits: Optional[torch.Tensor] = None,
+    ):
         super().__init__()
 
-        self._validation_info_list = validation_info_list
+        if validation_info_list is not None:
+            tokens = [vi["tokens"] for vi in validation_info_list]
+            logits = [vi.get("logits", None) for vi in validation_info_list]
+            if any(sentence_logits is None for sentence_logits in logits):
+                logits = None
+
+        self.tokens = _maybe_stack(tokens)
+        self.logits = _maybe_stack(logits)
 
     def __iter__(self):
-        for vi in self._validation_info_list:
-            yield vi
+        for sentence_i in range(len(self)):
+            sentence_logits = None if self.logits is None else self.logits[sentence_i]
+            yield {"tokens": self.tokens[sentence_i], "logits": sentence_logits}
 
     def get_info(self, info_name):
-        return [
-            [t.unsqueeze(0) for t in sentence[info_name]]
-            for sentence in self._validation_info_list
-        ]
+        """Get the per-token information for every sentence
+
+        Each token entry keeps a leading dimension of 1 (tokens -> (1,), logits -> (1, vocab_size)). When the
+        information is batched, a (batch_size, num_tokens, 1, ...) view is returned, otherwise a list with one
+        (num_tokens, 1, ...) view per sentence.
 
-    def save(self, save_dir_path: str):
+        :param info_name: the information to get, one of tokens or logits
+        :return: the per-token information for every sentence
+        """
+        info = {"tokens": self.tokens, "logits": self.logits}[info_name]
+        if info is None:
+            return None
+        if isinstance(info, torch.Tensor):
+            return info.unsqueeze(2)
+        return [t.unsqueeze(1) for t in info]
+
+    def save(self, save_dir_path: str, consolidated: bool = False):
         """Save the validation information into a directory.
 
         The files will be saved in the following structure:
@@ -107,20 +232,38 @@ class ValidationInfo:
         if containing only tokens - torch.tensor
         if containing tokens and logits - dict[tokens -> torch.tensor, logits -> torch.tensor]
 
+        If consolidated, a single save_dir_path.pt file is written instead, containing
+        dict[tokens -> batched torch.tensor, logits -> batched torch.tensor or None]
+
         :param save_dir_path: the path to save to
+        :param consolidated: save all the prompts into a single file rather than one file per prompt
         """
+        if consolidated:
+            file_path = f"{save_dir_path}.pt"
+            dprint(f"saving validation info to {file_path}")
+            os.makedirs(os.path.dirname(os.path.abspath(file_path)), exist_ok=True)
+            torch.save({"tokens": self.tokens, "logits": self.logits}, file_path)
+            return
+
         dprint(f"saving validation info to {save_dir_path}")
         os.makedirs(save_dir_path, exist_ok=True)
 
-        for sentence_i, sentence in enumerate(self._validation_info_list):
+        for sentence_i, sentence in enumerate(self):
             file_path = os.path.join(save_dir_path, f"{sentence_i}.pt")
-            if len(sentence) > 1:
-                torch.save(sentence, file_path)
+            # clone the per-sentence views, otherwise torch.save would serialize the whole batched storage
+            if sentence["logits"] is None:
+                torch.save(sentence["tokens"].clone(), file_path)
             else:
-                torch.save(list(sentence.values())[0], file_path)
+                torch.save(
+                    {
+                        "tokens": sentence["tokens"].clone(),
+                        "logits": sentence["logits"].clone(),
+                    },
+                    file_path,
+                )
 
     def __len__(self):
-        return len(self._validation_info_list)
+        return len(self.tokens)
 
 
 def get_default_validation_prefix(
@@ -129,6 +272,24 @@ def get_default_validation_prefix(
     return f"{model_id.replace('/', '--')}_max-new-tokens-{max_new_tokens}_batch-size-{batch_size}_seq-length-{seq_length}_dtype-{dtype}"
 
 
+def _read_validation_file(validation_file_path: Path, validation_files_type: str):
+    if validation_files_type == "text":
+        return validation_file_path.read_text(encoding="utf-8")
+    elif validation_files_type in ("tokens", "logits"):
+        return torch.load(validation_file_path, map_location="cpu", mmap=True)
+    return None
+
+
+def _is_consolidated(validation_file_content) -> bool:
+    # a consolidated file (see ValidationInfo.save) holds the tokens of all the prompts batched together
+    if not isinstance(validation_file_content, MutableMapping):
+        return False
+    tokens = validation_file_content.get("tokens", None)
+    return isinstance(tokens, list) or (
+        isinstance(tokens, torch.Tensor) and tokens.dim() == 2
+    )
+
+
 def load_validation_information(
     validation_path, validation_files_type, batch_size, tokenizer=None
 ):
@@ -148,6 +309,8 @@ def load_validation_information(
     if containing tokens and logits - dict[tokens -> torch.tensor, logits -> torch.tensor]
     if containing text - str
 
+    validation_path may also point to a single consolidated file written by ValidationInfo.save(consolidated=True)
+
     :param validation_path: path to validation info files
     :param validation_files_type: validation file type to load, one of text, tokens, or logits
     :param batch_size: the number of prompts to load
@@ -163,25 +326,44 @@ def load_validation_information(
 
     validation_files_path = Path(os.path.expanduser(validation_files_path))
     validation_files_paths = []
+    validation_files_contents = None
 
     if validation_files_path.is_dir():
         if glob_pattern != "":
-            glob_pattern_list = [glob_pattern]
+            validation_files_paths = sorted(validation_files_path.glob(glob_pattern))
         else:
-            if validation_files_type == "text":
-                glob_pattern_list = ["*.txt"]
-            elif validation_files_type == "tokens":
-                glob_pattern_list = ["*.pt"]
-            elif validation_files_type == "logits":
-                glob_pattern_list = ["*.pt"]
-        for glob_pattern_possibility in glob_pattern_list:
-            file_list = list(validation_files_path.glob(glob_pattern_possibility))
-            if len(file_list) > 0:
-                validation_files_paths = sorted(file_list)
-                break
+            extension = ".txt" if validation_files_type == "text" else ".pt"
+            # a single scan of the directory, scandir entries usually don't need a stat per file
+            with os.scandir(validation_files_path) as entries:
+                validation_files_names = sorted(
+                    entry.name
+                    for entry in entries
+                    if entry.is_file() and entry.name.endswith(extension)
+                )
+            validation_files_paths = [
+                validation_files_path / name for name in validation_files_names
+            ]
 
     if validation_files_path.is_file():
         validation_files_paths = [validation_files_path]
+        if validation_files_type in ("tokens", "logits"):
+            # files are memory mapped, so peeking at the content is cheap
+            validation_file_content = _read_validation_file(
+                validation_files_path, validation_files_type
+            )
+            if _is_consolidated(validation_file_content):
+                tokens = validation_file_content["tokens"]
+                logits = validation_file_content["logits"]
+                assert len(tokens) >= batch_size, (
+                    f"Not enough prompts in {validation_files_path} for a batch size of {batch_size}"
+                )
+                if validation_files_type == "tokens" or logits is None:
+                    return ValidationInfo(tokens=tokens[:batch_size])
+                return ValidationInfo(
+                    tokens=tokens[:batch_size], logits=logits[:batch_size]
+                )
+            # a single per-prompt file, reuse what was read instead of reading it again
+            validation_files_contents = [validation_file_content]
 
     # Check if we found some files
     assert len(validation_files_paths) > 0, (
@@ -193,20 +375,31 @@ def load_validation_information(
         f"Not enough validation files at {validation_files_path} for a batch size of {batch_size}"
     )
 
+    if validation_files_type == "text" and tokenizer is None:
+        raise ValueError("must provide a tokenizer when validation_files_type=text")
+
+    # read the files concurrently to overlap their I/O latency, results are kept in file order
+    if validation_files_contents is None:
+        validation_files_paths = validation_files_paths[:batch_size]
+        with ThreadPoolExecutor(max_workers=min(16, batch_size)) as executor:
+            validation_files_contents = list(
+                executor.map(
+                    partial(
+                        _read_validation_file,
+                        validation_files_type=validation_files_type,
+                    ),
+                    validation_files_paths,
+                )
+            )
+
     validation_info = []
-    for i, validation_file_path in enumerate(validation_files_paths):
-        if i == batch_size:
-            break
+    for validation_file_content in validation_files_contents:
         if validation_files_type == "text":
-            if tokenizer is None:
-                raise ValueError(
-                    "must provide a tokenizer when validation_files_type=text"
-                )
-            # Text format will get tokenized
+            # Text format will get tokenized (on this thread, tokenizers are not guaranteed to be thread safe)
             validation_info.append(
                 {
                     "tokens": tokenizer.encode(
-                        validation_file_path.read_text(encoding="utf-8"),
+                        validation_file_content,
                         return_tensors="pt",
                     ).squeeze(0),
                     "logits": None,
@@ -217,18 +410,28 @@ def load_validation_information(
             # Assumption: the file contains the token tensor as-is
             validation_info.append(
                 {
-                    "tokens": torch.load(validation_file_path, map_location="cpu"),
+                    "tokens": validation_file_content,
                     "logits": None,
                 }
             )
         elif validation_files_type == "logits":
             # Logits+tokens are loaded as is
             # Assumption: the file contains the dictionary with both tokens and logits
-            validation_info.append(torch.load(validation_file_path, map_location="cpu"))
+            validation_info.append(validation_file_content)
 
     return ValidationInfo(validation_info)
 
 
+def _to_cpu(tensor: torch.Tensor) -> torch.Tensor:
+    # on cuda, the copy is a non-blocking one into a pinned cpu buffer, the caller must synchronize before using it
+    if tensor.device.type == "cuda":
+        cpu_tensor = torch.empty(
+            tensor.shape, dtype=tensor.dtype, device="cpu", pin_memory=True
+        )
+        return cpu_tensor.copy_(tensor, non_blocking=True)
+    return tensor.to("cpu")
+
+
 def extract_validation_information(
     model,
     input_ids,
@@ -284,19 +487,57 @@ def extract_validation_information(
     if len(result.shape) == 1:
         result = result.unsqueeze(0)
 
-    if hasattr(post_iteration_hook, "extracted_logits"):
-        validation_info = [
-            {"tokens": t.to("cpu"), "logits": logits.to("cpu")}
-            for t, logits in zip(
-                torch.unbind(result), torch.unbind(post_iteration_hook.extracted_logits)
-            )
-        ]
-    else:
-        validation_info = [{"tokens": t.to("cpu")} for t in torch.unbind(result)]
-    return ValidationInfo(validation_info)
+    # move the whole batch to cpu at once rather than one transfer per sentence
+    # (streamed logits are already on cpu and are left memory mapped)
+    extracted_logits = getattr(post_iteration_hook, "extracted_logits", None)
+    needs_synchronize = any(
+        t is not None and t.device.type == "cuda" for t in (result, extracted_logits)
+    )
+    result = _to_cpu(result)
+    if extracted_logits is not None:
+        extracted_logits = _to_cpu(extracted_logits)
+    if needs_synchronize:
+        # a single synchronization for both of the asynchronous cuda transfers
+        torch.cuda.synchronize()
+    return ValidationInfo(tokens=result, logits=extracted_logits)
 
 
 def validate_level_0(aiu_tokens_per_sentence, validation_tokens_per_sentence):
+    aiu_tokens_per_sentence = _maybe_stack(aiu_tokens_per_sentence)
+    validation_tokens_per_sentence = _maybe_stack(validation_tokens_per_sentence)
+
+    if isinstance(aiu_tokens_per_sentence, torch.Tensor) and isinstance(
+        validation_tokens_per_sentence, torch.Tensor
+    ):
+        # batched (batch_size, num_tokens, ...) tokens, compare them all at once
+        num_sentences = min(
+            aiu_tokens_per_sentence.size(0), validation_tokens_per_sentence.size(0)
+        )
+        num_tokens = min(
+            aiu_tokens_per_sentence.size(1), validation_tokens_per_sentence.size(1)
+        )
+        # (batch_size, num_tokens, ...) -> (batch_size, num_tokens, n), this also holds when num_tokens is 0
+        aiu_tokens = (
+            aiu_tokens_per_sentence[:num_sentences, :num_tokens]
+            .unsqueeze(-1)
+            .flatten(2)
+        )
+        validation_tokens = (
+            validation_tokens_per_sentence[:num_sentences, :num_tokens]
+            .unsqueeze(-1)
+            .flatten(2)
+        )
+
+        # most validations pass, so check for an exact match first
+        if torch.equal(aiu_tokens, validation_tokens):
+            return []
+
+        mismatch = (aiu_tokens != validation_tokens).any(dim=-1)
+        return [
+            (sentence_idx, token_idx)
+            for sentence_idx, token_idx in mismatch.nonzero().tolist()
+        ]
+
     failed_cases = []
 
     for sentence_idx, (aiu_sentence, validation_sentence) in enumerate(
@@ -322,23 +563,86 @@ def top_k_loss_calculator(
     """
 
     def loss_func(reference_logits, test_logits):
-        reference_logits_prob = reference_logits.to(dtype=torch.float32)
-        test_logits_prob = test_logits.to(dtype=torch.float32)
+        # upcasting is exact, so select the top_k first and only upcast the selected values rather than the whole vocab
+        reference_values, reference_indices = torch.topk(reference_logits, top_k, dim=1)
+        test_values = torch.gather(test_logits, 1, reference_indices)
 
-        reference_values, reference_indices = torch.topk(
-            reference_logits_prob, top_k, dim=1
+        return loss_f(
+            reference_values.to(dtype=torch.float32),
+            test_values.to(dtype=torch.float32),
         )
-        test_values = test_logits_prob[:, reference_indices.squeeze(0)]
-
-        return loss_f(reference_values, test_values)
 
     return loss_func
 
 
+def _batched_cross_entropy(reference_logits, test_logits):
+    # cross entropy of each row of reference logits against the softmaxed test logits, (N, V) -> (N,)
+    return torch.nn.functional.cross_entropy(
+        reference_logits.to(dtype=torch.float32),
+        test_logits.softmax(dim=-1).to(dtype=torch.float32),
+        reduction="none",
+    )
+
+
+def capture_level_1_losses(reference_logits_per_sentence, test_logits_per_sentence):
+    """Compute the cross entropy loss of every token of batched logits in a single call
+
+    :param reference_logits_per_sentence: (batch_size, num_tokens, 1, vocab_size) logits, as returned by
+        ValidationInfo.get_info("logits"), or a list of same-shaped per-sentence logits
+    :param test_logits_per_sentence: the logits to compare against the reference logits, in the same layout
+    :return: a (batch_size, num_tokens) float32 tensor of losses, truncated to the shorter of the two inputs
+    """
+    reference_logits_per_sentence = _maybe_stack(reference_logits_per_sentence)
+    test_logits_per_sentence = _maybe_stack(test_logits_per_sentence)
+    if not isinstance(reference_logits_per_sentence, torch.Tensor) or not isinstance(
+        test_logits_per_sentence, torch.Tensor
+    ):
+        raise ValueError(
+            "level 1 losses can only be computed for batched logits, use capture_level_1_metrics instead"
+        )
+
+    num_sentences = min(
+        reference_logits_per_sentence.size(0), test_logits_per_sentence.size(0)
+    )
+    num_tokens = min(
+        reference_logits_per_sentence.size(1), test_logits_per_sentence.size(1)
+    )
+    vocab_size = reference_logits_per_sentence.size(-1)
+    return _batched_cross_entropy(
+        reference_logits_per_sentence[:num_sentences, :num_tokens].reshape(
+            -1, vocab_size
+        ),
+        test_logits_per_sentence[:num_sentences, :num_tokens].reshape(-1, vocab_size),
+    ).view(num_sentences, num_tokens)
+
+
 def capture_level_1_metrics(
     reference_logits_per_sentence, test_logits_per_sentence, metrics_calculator=None
 ):
+    if (
+        metrics_calculator is None
+        and isinstance(reference_logits_per_sentence, torch.Tensor)
+        and isinstance(test_logits_per_sentence, torch.Tensor)
+    ):
+        # batched (batch_size, num_tokens, 1, vocab_size) logits, compute the loss of every token in a single call
+        losses = capture_level_1_losses(
+            reference_logits_per_sentence, test_logits_per_sentence
+        )
+        # build the (sentence_idx, token_idx, metrics_value) tuples from flat lists, the metrics values stay 0-d
+        # tensors (as in the per-token path) but are split off with a single unbind
+        sentence_idxs, token_idxs = torch.meshgrid(
+            torch.arange(losses.size(0)), torch.arange(losses.size(1)), indexing="ij"
+        )
+        return list(
+            zip(
+                sentence_idxs.flatten().tolist(),
+                token_idxs.flatten().tolist(),
+                losses.flatten().unbind(),
+            )
+        )
+
     loss_metrics = []
+    loss_fn = torch.nn.CrossEntropyLoss()
 
     for sentence_idx, (reference_sentence, test_sentence) in enumerate(
         zip(reference_logits_per_sentence, test_logits_per_sentence)
@@ -348,7 +652,6 @@ def capture_level_1_metrics(
         ):
             # computing cross entropy loss per token
             if metrics_calculator is None:
-                loss_fn = torch.nn.CrossEntropyLoss()
                 metrics_value = loss_fn(
                     reference_logits.to(dtype=torch.float32),
                     test_logits.softmax(dim=1).to(dtype=torch.float32),
@@ -361,25 +664,71 @@ def capture_level_1_metrics(
     return loss_metrics
 
 
-def filter_failed_level_1_cases(level_1_loss_metrics, fail_f, print_failed=False):
-    failed_cases = []
-    for sentence_idx, token_idx, metrics_value in level_1_loss_metrics:
-        if fail_f(metrics_value):
-            failed_cases.append((sentence_idx, token_idx, metrics_value))
-            if print_failed:
-                dprint(
-                    f"In sentence {sentence_idx + 1}, the metric for token {token_idx} is {metrics_value}"
+def filter_failed_level_1_cases(
+    level_1_loss_metrics, fail_f=None, print_failed=False, threshold=None
+):
+    """Filter the level 1 metrics down to the failed cases
+
+    :param level_1_loss_metrics: the (sentence_idx, token_idx, metrics_value) list from capture_level_1_metrics, or
+        the (batch_size, num_tokens) tensor of losses from capture_level_1_losses when using threshold
+    :param fail_f: a function which returns True when a metrics value fails, called per token
+    :param print_failed: print the failed cases
+    :param threshold: scalar metrics values greater than or equal to this threshold fail, a tensor of losses is
+        compared with a single mask
+    :return: the (sentence_idx, token_idx, metrics_value) of the failed cases
+    """
+    if threshold is not None:
+        if isinstance(level_1_loss_metrics, torch.Tensor):
+            failed_mask = level_1_loss_metrics >= threshold
+            failed_cases = [
+                (sentence_idx, token_idx, metrics_value)
+                for (sentence_idx, token_idx), metrics_value in zip(
+                    failed_mask.nonzero().tolist(),
+                    level_1_loss_metrics[failed_mask].unbind(),
                 )
+            ]
+        else:
+            failed_cases = [
+                (sentence_idx, token_idx, metrics_value)
+                for sentence_idx, token_idx, metrics_value in level_1_loss_metrics
+                if metrics_value >= threshold
+            ]
+    elif fail_f is not None:
+        failed_cases = [
+            (sentence_idx, token_idx, metrics_value)
+            for sentence_idx, token_idx, metrics_value in level_1_loss_metrics
+            if fail_f(metrics_value)
+        ]
+    else:
+        raise ValueError("must provide either fail_f or threshold")
+
+    if print_failed:
+        for sentence_idx, token_idx, metrics_value in failed_cases:
+            dprint(
+                f"In sentence {sentence_idx + 1}, the metric for token {token_idx} is {metrics_value}"
+            )
     return failed_cases
 
 
 def print_failed_cases(failed_cases, aiu_tokens, validation_tokens, tokenizer):
-    for sentence_index, token_index in failed_cases:
-        aiu_token = aiu_tokens[sentence_index][token_index]
-        validation_token = validation_tokens[sentence_index][token_index]
+    aiu_failed_tokens = [
+        aiu_tokens[sentence_index][token_index]
+        for sentence_index, token_index in failed_cases
+    ]
+    validation_failed_tokens = [
+        validation_tokens[sentence_index][token_index]
+        for sentence_index, token_index in failed_cases
+    ]
+
+    # failures tend to repeat the same few tokens, so decode every distinct token id only once
+    token_ids = sorted({int(t) for t in aiu_failed_tokens + validation_failed_tokens})
+    id_to_str = dict(
+        zip(token_ids, tokenizer.batch_decode([[token_id] for token_id in token_ids]))
+    )
 
-        aiu_str = tokenizer.decode(aiu_token)
-        validation_str = tokenizer.decode(validation_token)
+    for i, (sentence_index, token_index) in enumerate(failed_cases):
+        aiu_str = id_to_str[int(aiu_failed_tokens[i])]
+        validation_str = id_to_str[int(validation_failed_tokens[i])]
         print(
-            f"In sentence {sentence_index + 1}/{len(aiu_tokens)}, token {token_index}, AIU outputs {aiu_token} instead of {validation_token} -- AIU val={aiu_str} -- CPU val={validation_str}"
+            f"In sentence {sentence_index + 1}/{len(aiu_tokens)}, token {token_index}, AIU outputs {aiu_failed_tokens[i]} instead of {validation_failed_tokens[i]} -- AIU val={aiu_str} -- CPU val={validation_str}"
         )
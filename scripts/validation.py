@@ -17,7 +17,8 @@ from torch import distributed as dist
 from aiu_fms_testing_utils.utils import warmup_model
 from aiu_fms_testing_utils.testing.validation import (
     LogitsExtractorHook,
-    capture_level_1_metrics,
+    ValidationInfo,
+    capture_level_1_losses,
     extract_validation_information,
     GoldenTokenHook,
     filter_failed_level_1_cases,
@@ -608,7 +609,7 @@ def print_result(result, result_idx: int = 0, file_prefix: str = ""):
     if local_rank != 0:
         return
 
-    result = torch.tensor(result)
+    result = torch.as_tensor(result).view(-1)
     if has_padding:
         result = generation.trim_prefix(result)
 
@@ -641,7 +642,7 @@ if not needs_validation_generation:
         tokenizer,
     )
 
-    val_tokens = [torch.tensor(_) for _ in validation_info.get_info("tokens")]
+    val_tokens = [t.view(-1) for t in validation_info.get_info("tokens")]
     max_val_len = max([prompt.size(0) for prompt in val_tokens])
     val_num_gen_tokens = int(args.max_new_tokens)
     if max_allowed_length is not None:
@@ -662,9 +663,7 @@ if not needs_validation_generation:
         val_ids = val_tokens
         padding_val_kwargs = None
 
-    val_ids_list = torch.unbind(val_ids)
-    for idx, validation_dict in enumerate(validation_info):
-        validation_dict["tokens"] = val_ids_list[idx]
+    validation_info = ValidationInfo(tokens=val_ids, logits=validation_info.logits)
 
     if needs_validation_run:
         val_ids = val_ids.to(validation_device)
@@ -676,14 +675,11 @@ if not needs_validation_generation:
             # Bug in 2.3.1 fixed in 2.4.1 for SDPA flash cpu impl when padding too much
             padding_val_kwargs["attn_algorithm"] = "math"
 
-        val_logits = torch.unbind(
-            validation_model(val_ids, **padding_val_kwargs).to("cpu")
-        )
-
-        for idx, validation_dict in enumerate(validation_info):
-            if validation_dict["logits"] is None:
-                # Generate the logits by running the model forward pass
-                validation_dict["logits"] = val_logits[idx]
+        if validation_info.logits is None:
+            # Generate the logits by running the model forward pass
+            validation_info.logits = validation_model(val_ids, **padding_val_kwargs).to(
+                "cpu"
+            )
 else:
     validation_info = extract_validation_information(
         validation_model,
@@ -723,12 +719,12 @@ aiu_static_tokens = aiu_validation_info.get_info("tokens")
 if args.validation_level == 0:
     failed_cases = validate_level_0(aiu_static_tokens, static_tokens)
 else:
-    level_1_metrics = capture_level_1_metrics(
+    level_1_losses = capture_level_1_losses(
         validation_info.get_info("logits"), aiu_validation_info.get_info("logits")
     )
 
     failed_cases = filter_failed_level_1_cases(
-        level_1_metrics, lambda m: m >= args.logits_loss_threshold
+        level_1_losses, threshold=args.logits_loss_threshold
     )
 
 validation_passed = len(failed_cases) == 0
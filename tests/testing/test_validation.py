@@ -1,9 +1,14 @@
 import tempfile
 import pytest
 from aiu_fms_testing_utils.testing.validation import (
+    GoldenTokenHook,
     LogitsExtractorHook,
+    capture_level_1_losses,
+    capture_level_1_metrics,
     extract_validation_information,
+    filter_failed_level_1_cases,
     load_validation_information,
+    validate_level_0,
 )
 from fms.models import get_model
 from fms.utils.generation import pad_input_ids
@@ -11,10 +16,13 @@ import torch
 
 
 @pytest.mark.parametrize(
-    "validation_type,post_iteration_hook",
-    [("logits", LogitsExtractorHook()), ("tokens", None)],
+    "validation_type,post_iteration_hook_cls",
+    [("logits", LogitsExtractorHook), ("tokens", None)],
 )
-def test_validation_info_round_trip(validation_type, post_iteration_hook):
+@pytest.mark.parametrize("consolidated", [False, True])
+def test_validation_info_round_trip(
+    validation_type, post_iteration_hook_cls, consolidated
+):
     # prepare a small cpu model
     model = get_model(
         "llama",
@@ -37,23 +45,26 @@ def test_validation_info_round_trip(validation_type, post_iteration_hook):
         )
 
     input_ids, padding_kwargs = pad_input_ids(prompt_list, min_pad_length=seq_length)
+    padding_kwargs["attn_name"] = "sdpa_causal"
 
     # generate cpu validation info
     generated_validation_info = extract_validation_information(
         model,
         input_ids,
         max_new_tokens,
-        post_iteration_hook,
+        None if post_iteration_hook_cls is None else post_iteration_hook_cls(),
         attn_algorithm="math",
         **padding_kwargs,
     )
 
     with tempfile.TemporaryDirectory() as workdir:
         output_path = f"{workdir}/validation_info"
-        generated_validation_info.save(output_path)
+        generated_validation_info.save(output_path, consolidated=consolidated)
 
         loaded_validation_info = load_validation_information(
-            output_path, validation_type, batch_size
+            f"{output_path}.pt" if consolidated else output_path,
+            validation_type,
+            batch_size,
         )
 
         assert len(generated_validation_info) == len(loaded_validation_info)
@@ -64,3 +75,151 @@ def test_validation_info_round_trip(validation_type, post_iteration_hook):
             assert gen_vi_no_none.keys() == loaded_vi_no_none.keys()
             for k in gen_vi_no_none.keys():
                 torch.testing.assert_close(gen_vi_no_none[k], loaded_vi_no_none[k])
+
+
+def test_logits_extractor_hook_mmap():
+    batch_size = 2
+    max_new_tokens = 4
+    vocab_size = 16
+
+    logits_per_step = [
+        torch.randn(batch_size, vocab_size, dtype=torch.float32)
+        for _ in range(max_new_tokens)
+    ]
+    next_val = torch.zeros(batch_size, 1, dtype=torch.long)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        in_memory_hook = LogitsExtractorHook()
+        mmap_hook = LogitsExtractorHook(
+            mmap_path=f"{workdir}/logits.bin", max_new_tokens=max_new_tokens
+        )
+        # max_new_tokens defaults to the number of static tokens
+        golden_token_hook = GoldenTokenHook(
+            torch.zeros(batch_size, max_new_tokens, dtype=torch.long),
+            mmap_path=f"{workdir}/golden_logits.bin",
+        )
+        for token_position, logits in enumerate(logits_per_step):
+            in_memory_hook(token_position, logits, next_val, {})
+            mmap_hook(token_position, logits, next_val, {})
+            golden_token_hook(token_position, logits, next_val, {})
+
+        assert in_memory_hook.extracted_logits.shape == (
+            batch_size,
+            max_new_tokens,
+            vocab_size,
+        )
+        torch.testing.assert_close(
+            mmap_hook.extracted_logits, in_memory_hook.extracted_logits
+        )
+        torch.testing.assert_close(
+            golden_token_hook.extracted_logits, in_memory_hook.extracted_logits
+        )
+
+
+def test_validate_level_0_batched_matches_per_token():
+    aiu_tokens = torch.tensor([[1, 2, 3, 4, 5, 6], [7, 8, 9, 10, 11, 12]])
+    validation_tokens = torch.tensor([[1, 2, 0, 4, 5], [7, 8, 9, 10, 0]])
+
+    # nested lists of per-token tensors go through the per-token loop
+    per_token_failed_cases = validate_level_0(
+        [[t.unsqueeze(0) for t in sentence] for sentence in aiu_tokens],
+        [[t.unsqueeze(0) for t in sentence] for sentence in validation_tokens],
+    )
+    # only the first 5 tokens are compared
+    assert per_token_failed_cases == [(0, 2), (1, 4)]
+
+    # (batch_size, num_tokens, 1), as returned by ValidationInfo.get_info("tokens")
+    assert (
+        validate_level_0(aiu_tokens.unsqueeze(2), validation_tokens.unsqueeze(2))
+        == per_token_failed_cases
+    )
+    assert validate_level_0(aiu_tokens, validation_tokens) == per_token_failed_cases
+    assert validate_level_0(aiu_tokens.unsqueeze(2), aiu_tokens.unsqueeze(2)) == []
+    assert validate_level_0([], []) == []
+    assert (
+        validate_level_0(
+            torch.zeros(2, 0, dtype=torch.long), torch.zeros(2, 0, dtype=torch.long)
+        )
+        == []
+    )
+
+    # values are compared as given, not after a float32 round trip
+    assert filter_failed_level_1_cases([(0, 0, 0.99999999)], threshold=1.0) == []
+
+
+@pytest.mark.parametrize("dtype", [torch.float32, torch.float16])
+def test_capture_level_1_metrics_batched_matches_per_token(dtype):
+    torch.manual_seed(0)
+    batch_size = 3
+    num_tokens = 5
+    vocab_size = 1000
+
+    # (batch_size, num_tokens, 1, vocab_size), as returned by ValidationInfo.get_info("logits")
+    reference_logits = torch.randn(batch_size, num_tokens, 1, vocab_size).to(dtype)
+    test_logits = (
+        reference_logits.float() + 0.1 * torch.randn_like(reference_logits.float())
+    ).to(dtype)
+
+    batched_metrics = capture_level_1_metrics(reference_logits, test_logits)
+    # a list of per-sentence tensors goes through the per-token loop
+    per_token_metrics = capture_level_1_metrics(
+        list(reference_logits), list(test_logits)
+    )
+
+    # the original per-token computation
+    expected_metrics = [
+        (
+            sentence_idx,
+            token_idx,
+            torch.nn.CrossEntropyLoss()(
+                reference_logits[sentence_idx, token_idx].to(dtype=torch.float32),
+                test_logits[sentence_idx, token_idx]
+                .softmax(dim=1)
+                .to(dtype=torch.float32),
+            ),
+        )
+        for sentence_idx in range(batch_size)
+        for token_idx in range(num_tokens)
+    ]
+
+    for metrics in (batched_metrics, per_token_metrics):
+        assert [m[:2] for m in metrics] == [m[:2] for m in expected_metrics]
+        for (_, _, value), (_, _, expected_value) in zip(metrics, expected_metrics):
+            assert isinstance(value, torch.Tensor) and value.dim() == 0
+            torch.testing.assert_close(value, expected_value)
+
+    losses = capture_level_1_losses(reference_logits, test_logits)
+    assert losses.shape == (batch_size, num_tokens)
+    torch.testing.assert_close(
+        losses.flatten(), torch.stack([m[2] for m in expected_metrics])
+    )
+
+
+def test_filter_failed_level_1_cases_threshold():
+    losses = torch.tensor([[0.1, 2.0, 0.3], [1.5, 0.2, 1.0]])
+    level_1_metrics = [
+        (sentence_idx, token_idx, losses[sentence_idx, token_idx].item())
+        for sentence_idx in range(losses.size(0))
+        for token_idx in range(losses.size(1))
+    ]
+
+    expected_failed_cases = filter_failed_level_1_cases(
+        level_1_metrics, lambda m: m >= 1.0
+    )
+    assert [case[:2] for case in expected_failed_cases] == [(0, 1), (1, 0), (1, 2)]
+    assert (
+        filter_failed_level_1_cases(level_1_metrics, threshold=1.0)
+        == expected_failed_cases
+    )
+
+    # a tensor of losses, as returned by capture_level_1_losses, keeps 0-d tensor values
+    tensor_failed_cases = filter_failed_level_1_cases(losses, threshold=1.0)
+    assert [case[:2] for case in tensor_failed_cases] == [(0, 1), (1, 0), (1, 2)]
+    for (_, _, value), (_, _, expected_value) in zip(
+        tensor_failed_cases, expected_failed_cases
+    ):
+        assert isinstance(value, torch.Tensor) and value.dim() == 0
+        assert value.item() == expected_value
+
+    # values are compared as given, not after a float32 round trip
+    assert filter_failed_level_1_cases([(0, 0, 0.99999999)], threshold=1.0) == []